@@ -1,8 +1,16 @@
 #!/usr/bin/env python3
 """
-Local development server runner for Gemini WebAPI
+Server runner for Gemini WebAPI
+
+    python run_server.py           # development, single process with auto reload (same as --dev)
+    python run_server.py --serve   # production, one worker per CPU core
+
+In --serve mode each worker is a separate process with its own client cache, so a user's
+GeminiClient is initialized once per worker that serves them. Tune with the WORKERS and
+CONCURRENCY environment variables.
 """
 
+import argparse
 import os
 import sys
 from pathlib import Path
@@ -13,7 +21,21 @@ sys.path.insert(0, str(src_path))
 
 if __name__ == "__main__":
     import uvicorn
-    
+
+    parser = argparse.ArgumentParser(description="Run the Gemini WebAPI server")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--dev",
+        action="store_true",
+        help="single process with auto reload on changes in src/ (default)",
+    )
+    mode.add_argument(
+        "--serve",
+        action="store_true",
+        help="production mode without reload, runs WORKERS processes (default: CPU count)",
+    )
+    args = parser.parse_args()
+
     print("🚀 Starting Gemini WebAPI server...")
     print("📍 Server will be available at: http://localhost:8000")
     print("📖 API docs available at: http://localhost:8000/docs")
@@ -21,12 +43,31 @@ if __name__ == "__main__":
     print()
     print("ℹ️  Authentication: Provide __Secure-1PSID and __Secure-1PSIDTS cookies in request headers")
     print()
-    
+
+    # uvloop is not available on Windows, fall back to the default event loop there
+    loop = "uvloop" if sys.platform != "win32" else "auto"
+
     # Run the server
-    uvicorn.run(
-        "gemini_webapi.server:app",
-        host="0.0.0.0",
-        port=8000,
-        reload=True,
-        reload_dirs=["src"]
-    )
\ No newline at end of file
+    if args.serve:
+        uvicorn.run(
+            "gemini_webapi.server:app",
+            host="0.0.0.0",
+            port=8000,
+            workers=int(os.getenv("WORKERS", os.cpu_count() or 2)),
+            loop=loop,
+            http="httptools",
+            limit_concurrency=int(os.getenv("CONCURRENCY", "1000")),
+            timeout_keep_alive=30,
+        )
+    else:
+        uvicorn.run(
+            "gemini_webapi.server:app",
+            host="0.0.0.0",
+            port=8000,
+            reload=True,
+            reload_dirs=["src"],
+            loop=loop,
+            http="httptools",
+            timeout_keep_alive=30,
+            limit_concurrency=1000,
+        )
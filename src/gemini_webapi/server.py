@@ -4,16 +4,22 @@ Provides REST API endpoints compatible with the curl request format.
 """
 
 import asyncio
+import hashlib
 import os
+import re
+import time
 from pathlib import Path
-from typing import Optional, List
+from typing import Any, AsyncIterator, Awaitable, Callable, Hashable, Optional, List
 import tempfile
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager, suppress
+from http.cookiejar import CookieJar, DefaultCookiePolicy
 import aiofiles
 import httpx
+import orjson
 
-from fastapi import FastAPI, HTTPException, Request, File, UploadFile, Form
-from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, Response
+from fastapi import FastAPI, HTTPException, Request, File, UploadFile, Form, Depends, BackgroundTasks
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
 
 from .client import GeminiClient
@@ -23,6 +29,45 @@ from .utils import set_log_level
 # Set log level to INFO to hide DEBUG messages like cookie refresh
 set_log_level("INFO")
 
+# Public model names accepted by the API, mapped to Model enum
+MODEL_MAPPING = {
+    "gemini-3.0-pro": Model.G_3_0_PRO,
+    "gemini-2.5-pro": Model.G_2_5_PRO,
+    "gemini-2.5-flash": Model.G_2_5_FLASH,
+    "unspecified": Model.UNSPECIFIED,
+}
+_DEFAULT_MODEL = Model.G_2_5_FLASH
+
+# Matches __Secure-1PSID and __Secure-1PSIDTS in a raw Cookie header in a single pass
+_COOKIE_RE = re.compile(rb"(?:^|;\s*)(__Secure-1PSIDT?S?)=([^;\s]+)")
+
+# Maximum number of cached clients, least recently used ones are evicted beyond this
+_CACHE_MAX = int(os.getenv("GEMINI_CLIENT_CACHE_MAX", "256"))
+# Global LRU cache of (client, last used monotonic time) for different users
+_CLIENT_CACHE: "OrderedDict[str, tuple[GeminiClient, float]]" = OrderedDict()
+# Client inits in flight keyed by cache key, entries only live until the init finishes
+_CLIENT_INITS: dict[str, asyncio.Task] = {}
+# Number of requests currently using each client
+_CLIENT_USERS: "Counter[GeminiClient]" = Counter()
+# Clients dropped from the cache while still in use, closed when their last request finishes
+_RETIRED_IN_USE: set[GeminiClient] = set()
+
+# Clients unused for longer than this many seconds are closed by the background sweeper
+_CLIENT_IDLE_TTL = float(os.getenv("GEMINI_CLIENT_IDLE_TTL", "900"))
+# Seconds between two runs of the client cache sweeper
+_SWEEP_INTERVAL = 60
+
+# Chunk size used when spooling uploaded files to disk
+_UPLOAD_CHUNK_SIZE = 1 << 16
+
+# Chunk size used when streaming downloaded images to the caller
+_DOWNLOAD_CHUNK_SIZE = 1 << 16
+# Maximum number of redirects followed when downloading an image
+_MAX_REDIRECTS = 20
+
+# In-flight /generate calls keyed by (client, model, prompt digest), entries only live until the call finishes
+_INFLIGHT: dict[tuple, asyncio.Task] = {}
+
 
 class GenerateRequest(BaseModel):
     prompt: str
@@ -63,47 +108,216 @@ class ImageEditRequest(BaseModel):
     model: str = "gemini-2.5-flash"
 
 
+def _merge_vary_origin(headers: list[tuple[bytes, bytes]]) -> list[tuple[bytes, bytes]]:
+    """Add Origin to the response's Vary header, extending an existing one instead of duplicating it"""
+    for i, (name, value) in enumerate(headers):
+        if name.lower() == b"vary":
+            tokens = [t.strip().lower() for t in value.split(b",")]
+            if b"origin" not in tokens and b"*" not in tokens:
+                headers[i] = (name, value + b", Origin")
+            return headers
+
+    headers.append((b"vary", b"Origin"))
+    return headers
+
+
+class FastCORS:
+    """
+    Pure-ASGI CORS middleware allowing any origin with credentials.
+
+    All response headers are pre-encoded once, so per request the middleware only echoes the
+    caller's origin (browsers reject a literal `*` when credentials are allowed) and appends
+    the cached header tuples to the response start message.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._headers = [
+            (b"access-control-allow-credentials", b"true"),
+            (b"access-control-allow-methods", b"GET,POST,PUT,DELETE,OPTIONS,PATCH"),
+        ]
+        # 204 responses must not carry content-length (RFC 9110 section 8.6)
+        self._preflight_headers = self._headers + [
+            (b"access-control-max-age", b"600"),
+            (b"vary", b"Origin"),
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        origin = None
+        request_headers = None
+        is_preflight = False
+        for name, value in scope["headers"]:
+            if name == b"origin":
+                origin = value
+            elif name == b"access-control-request-method":
+                is_preflight = True
+            elif name == b"access-control-request-headers":
+                request_headers = value
+
+        # Not a cross-origin request, nothing to add
+        if origin is None:
+            await self.app(scope, receive, send)
+            return
+
+        if is_preflight and scope["method"] == "OPTIONS":
+            headers = [(b"access-control-allow-origin", origin), *self._preflight_headers]
+            if request_headers:
+                headers.append((b"access-control-allow-headers", request_headers))
+            await send({"type": "http.response.start", "status": 204, "headers": headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        cors_headers = [(b"access-control-allow-origin", origin), *self._headers]
+
+        async def send_with_cors(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = _merge_vary_origin([*message.get("headers", ()), *cors_headers])
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors)
+
+
+async def _sweep_client_cache():
+    """Periodically close and drop cached clients that are dead or have been idle too long"""
+    while True:
+        await asyncio.sleep(_SWEEP_INTERVAL)
+        now = time.monotonic()
+        for cache_key, (client, last_used) in list(_CLIENT_CACHE.items()):
+            if client._running and now - last_used <= _CLIENT_IDLE_TTL:
+                continue
+            _CLIENT_CACHE.pop(cache_key, None)
+            await _retire_client(client)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start the shared httpx client and client cache sweeper, and close everything on shutdown"""
+    # Pooled client for all outbound HTTP. It is shared by every user, so reject all cookies
+    # to keep the jar from carrying one user's cookies to another
+    app.state.http = httpx.AsyncClient(
+        timeout=30,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+        cookies=CookieJar(policy=DefaultCookiePolicy(allowed_domains=[])),
+    )
+    sweeper = asyncio.create_task(_sweep_client_cache())
+    try:
+        yield
+    finally:
+        sweeper.cancel()
+        with suppress(asyncio.CancelledError):
+            await sweeper
+
+        # Shielded client inits and /generate calls outlive their callers, don't leave them running past shutdown
+        for task in [*_CLIENT_INITS.values(), *_INFLIGHT.values()]:
+            task.cancel()
+
+        await app.state.http.aclose()
+
+        # One client failing to close must not keep the others open
+        for client in [*(c for c, _ in _CLIENT_CACHE.values()), *_RETIRED_IN_USE]:
+            await _close_client_quietly(client)
+        _CLIENT_CACHE.clear()
+        _RETIRED_IN_USE.clear()
+
+
 app = FastAPI(
     title="Gemini WebAPI Server",
     description="REST API server for Gemini WebAPI",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
 # Add CORS middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+app.add_middleware(FastCORS)
+
+
+class _MissingCookieError(Exception):
+    """Raised by client_dep when the request carries no __Secure-1PSID cookie"""
+
+
+# Pre-rendered 400 response, same body as HTTPException(400, detail=...) without serializing it per request
+_MISSING_PSID_RESPONSE = ORJSONResponse(
+    {"detail": "Missing required cookie: __Secure-1PSID. Please provide Gemini cookies in the Cookie header."},
+    status_code=400,
 )
 
-# Global client cache for different users
-client_cache = {}
 
+@app.exception_handler(_MissingCookieError)
+async def missing_cookie_handler(request: Request, exc: _MissingCookieError):
+    """Return the pre-rendered 400 response for requests without Gemini cookies"""
+    return _MISSING_PSID_RESPONSE
 
-async def get_client_for_cookies(secure_1psid: str, secure_1psidts: Optional[str] = None) -> GeminiClient:
-    """Get or create Gemini client instance for specific cookies"""
-    cache_key = f"{secure_1psid}:{secure_1psidts or ''}"
-    
-    if cache_key in client_cache:
-        client = client_cache[cache_key]
-        if client._running:
-            return client
-        else:
-            # Remove dead client from cache
-            del client_cache[cache_key]
-    
-    # Create new client
+
+def _get_cached_client(cache_key: str) -> Optional[GeminiClient]:
+    """Return a live cached client and mark it as recently used, dropping dead ones"""
+    entry = _CLIENT_CACHE.get(cache_key)
+    if entry is None:
+        return None
+
+    client = entry[0]
+    if client._running:
+        _CLIENT_CACHE[cache_key] = (client, time.monotonic())
+        _CLIENT_CACHE.move_to_end(cache_key)
+        return client
+
+    # Remove dead client from cache
+    del _CLIENT_CACHE[cache_key]
+    return None
+
+
+async def _close_client_quietly(client: GeminiClient) -> None:
+    """Close a client if it is still running, a failure here must not fail the request that triggered it"""
+    if client._running:
+        try:
+            await client.close()
+        except Exception:
+            pass
+
+
+async def _retire_client(client: GeminiClient) -> None:
+    """Close a client dropped from the cache, or leave it to the last request still using it"""
+    if _CLIENT_USERS[client]:
+        _RETIRED_IN_USE.add(client)
+    else:
+        await _close_client_quietly(client)
+
+
+async def _init_client(cache_key: str, secure_1psid: str, secure_1psidts: Optional[str]) -> GeminiClient:
+    """Initialize a new client, add it to the cache and evict least recently used clients beyond the bound"""
     client = GeminiClient(
         secure_1psid=secure_1psid,
         secure_1psidts=secure_1psidts
     )
-    
-    try:
-        await client.init(timeout=30, auto_close=False, auto_refresh=False)
-        client_cache[cache_key] = client
+    await client.init(timeout=30, auto_close=False, auto_refresh=False)
+
+    _CLIENT_CACHE[cache_key] = (client, time.monotonic())
+
+    while len(_CLIENT_CACHE) > _CACHE_MAX:
+        _, (evicted, _) = _CLIENT_CACHE.popitem(last=False)
+        await _retire_client(evicted)
+
+    return client
+
+
+async def get_client_for_cookies(secure_1psid: str, secure_1psidts: Optional[str] = None) -> GeminiClient:
+    """Get or create Gemini client instance for specific cookies"""
+    cache_key = f"{secure_1psid}:{secure_1psidts or ''}"
+
+    if client := _get_cached_client(cache_key):
         return client
+
+    # Concurrent requests with the same new cookies share one init, and all get its client or its error
+    try:
+        return await _single_flight(
+            _CLIENT_INITS,
+            cache_key,
+            lambda: _init_client(cache_key, secure_1psid, secure_1psidts),
+        )
     except Exception as e:
         raise HTTPException(
             status_code=401,
@@ -111,26 +325,160 @@ async def get_client_for_cookies(secure_1psid: str, secure_1psidts: Optional[str
         )
 
 
-def extract_cookies_from_request(request: Request) -> tuple[Optional[str], Optional[str]]:
-    """Extract Gemini cookies from request headers"""
-    cookie_header = request.headers.get("cookie", "")
-    
+def extract_cookies_from_scope(scope) -> tuple[Optional[str], Optional[str]]:
+    """Extract Gemini cookies from the raw ASGI headers without building a Request wrapper"""
     secure_1psid = None
     secure_1psidts = None
-    
-    # Parse cookies from header
-    for cookie in cookie_header.split(";"):
-        cookie = cookie.strip()
-        if cookie.startswith("__Secure-1PSID="):
-            secure_1psid = cookie.split("=", 1)[1]
-        elif cookie.startswith("__Secure-1PSIDTS="):
-            secure_1psidts = cookie.split("=", 1)[1]
-    
+
+    for name, value in scope["headers"]:
+        if name != b"cookie":
+            continue
+        for cookie_name, cookie_value in _COOKIE_RE.findall(value):
+            if cookie_name == b"__Secure-1PSID":
+                secure_1psid = cookie_value.decode("latin-1")
+            elif cookie_name == b"__Secure-1PSIDTS":
+                secure_1psidts = cookie_value.decode("latin-1")
+
     return secure_1psid, secure_1psidts
 
 
+async def cookies_dep(request: Request) -> tuple[Optional[str], Optional[str]]:
+    """FastAPI dependency returning (__Secure-1PSID, __Secure-1PSIDTS) from the Cookie header"""
+    return extract_cookies_from_scope(request.scope)
+
+
+async def client_dep(
+    cookies: tuple[Optional[str], Optional[str]] = Depends(cookies_dep),
+) -> AsyncIterator[GeminiClient]:
+    """
+    FastAPI dependency yielding the initialized client for the cookies in the request.
+
+    The client is marked as in use for the duration of the request, so cache eviction never closes it mid-call.
+    """
+    secure_1psid, secure_1psidts = cookies
+
+    if not secure_1psid:
+        raise _MissingCookieError()
+
+    client = await get_client_for_cookies(secure_1psid, secure_1psidts)
+    _CLIENT_USERS[client] += 1
+    try:
+        yield client
+    finally:
+        _CLIENT_USERS[client] -= 1
+        if not _CLIENT_USERS[client]:
+            del _CLIENT_USERS[client]
+            if client in _RETIRED_IN_USE:
+                _RETIRED_IN_USE.discard(client)
+                await _close_client_quietly(client)
+
+
+def _img_to_dict(img) -> dict:
+    """Convert an image from a model output into the dict returned by the API"""
+    return {
+        "url": img.url,
+        "title": getattr(img, "title", None),
+        "alt": getattr(img, "alt", None),
+        "type": "web" if hasattr(img, "proxy") else "generated"
+    }
+
+
+def _single_flight(
+    inflight: dict, key: Hashable, coro_factory: Callable[[], Awaitable[Any]]
+) -> Awaitable[Any]:
+    """
+    Run coro_factory() once for all concurrent callers with the same key in the inflight map.
+
+    Only the first caller starts the call, later callers await the same task until it finishes.
+    The task is shielded so one caller disconnecting does not cancel it for the others.
+    """
+    task = inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(coro_factory())
+        inflight[key] = task
+
+        def _done(t: asyncio.Task):
+            if inflight.get(key) is t:
+                del inflight[key]
+            # Mark the exception as retrieved in case every caller has gone away
+            if not t.cancelled():
+                t.exception()
+
+        task.add_done_callback(_done)
+
+    return asyncio.shield(task)
+
+
+async def _spool_upload(upload: UploadFile) -> str:
+    """Copy an uploaded file to a temporary path in fixed-size chunks without blocking the event loop"""
+    fd, path = await asyncio.to_thread(tempfile.mkstemp, suffix=Path(upload.filename or "").suffix)
+    os.close(fd)
+
+    try:
+        async with aiofiles.open(path, "wb") as f:
+            while chunk := await upload.read(_UPLOAD_CHUNK_SIZE):
+                await f.write(chunk)
+    except BaseException:
+        await asyncio.to_thread(_unlink_quiet, path)
+        raise
+
+    return path
+
+
+def _unlink_quiet(path: str) -> None:
+    """Remove a temporary file, ignoring it if it is already gone"""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+async def _remove_temp_files(paths: list[str]) -> None:
+    """Remove temporary files in worker threads, a failure on one file must not skip the others"""
+    await asyncio.gather(*[asyncio.to_thread(_unlink_quiet, p) for p in paths], return_exceptions=True)
+
+
+async def http_client_dep(request: Request) -> httpx.AsyncClient:
+    """FastAPI dependency returning the shared httpx client created in lifespan"""
+    return request.app.state.http
+
+
+async def _open_image_stream(http: httpx.AsyncClient, url: str, cookies: dict) -> httpx.Response:
+    """
+    Open a streaming GET for an image through the shared httpx client.
+
+    The shared client is used by every user, so its own cookie jar stays empty. Instead, each download
+    gets a per-request jar seeded with the user's cookies, and redirects are followed manually so cookies
+    set by intermediate hops are stored with their domain scoping and expiry, like GeneratedImage.save did.
+    """
+    jar = httpx.Cookies(cookies)
+
+    for _ in range(_MAX_REDIRECTS + 1):
+        request = http.build_request("GET", url)
+        jar.set_cookie_header(request)
+        response = await http.send(request, stream=True)
+        if not response.is_redirect:
+            break
+        jar.extract_cookies(response)
+        await response.aclose()
+        url = response.url.join(response.headers["location"])
+    else:
+        raise httpx.TooManyRedirects("Exceeded maximum allowed redirects.")
+
+    if response.status_code != 200:
+        await response.aclose()
+        raise httpx.HTTPError(
+            f"Error downloading image: {response.status_code} {response.reason_phrase}"
+        )
+
+    return response
+
+
 @app.post("/generate", response_model=GenerateResponse)
-async def generate_content(request: GenerateRequest, http_request: Request):
+async def generate_content(
+    request: GenerateRequest,
+    current_client: GeminiClient = Depends(client_dep),
+):
     """
     Generate content using Gemini API
     
@@ -141,44 +489,24 @@ async def generate_content(request: GenerateRequest, http_request: Request):
          -d '{"prompt":"写一段简短的自我介绍","model":"gemini-2.0-flash-exp"}'
     """
     
-    # Extract cookies from request header
-    req_psid, req_psidts = extract_cookies_from_request(http_request)
-    
-    if not req_psid:
-        raise HTTPException(
-            status_code=400,
-            detail="Missing required cookie: __Secure-1PSID. Please provide Gemini cookies in the Cookie header."
-        )
-    
-    # Get client for these specific cookies
-    current_client = await get_client_for_cookies(req_psid, req_psidts)
-    
     # Map model name to Model enum
-    model_mapping = {
-        "gemini-3.0-pro": Model.G_3_0_PRO,
-        "gemini-2.5-pro": Model.G_2_5_PRO,
-        "gemini-2.5-flash": Model.G_2_5_FLASH,
-        "unspecified": Model.UNSPECIFIED,
-    }
-    
-    model = model_mapping.get(request.model, Model.G_2_5_FLASH)
+    model = MODEL_MAPPING.get(request.model, _DEFAULT_MODEL)
     
     try:
-        # Generate content
-        response = await current_client.generate_content(
-            prompt=request.prompt,
-            model=model
+        # Generate content, sharing the upstream call with identical requests already in flight
+        inflight_key = (
+            current_client,
+            model,
+            hashlib.blake2b(request.prompt.encode(), digest_size=16).digest(),
+        )
+        response = await _single_flight(
+            _INFLIGHT,
+            inflight_key,
+            lambda: current_client.generate_content(prompt=request.prompt, model=model),
         )
         
         # Extract images information
-        images = []
-        for img in response.images:
-            images.append({
-                "url": img.url,
-                "title": img.title,
-                "alt": img.alt,
-                "type": "web" if hasattr(img, "proxy") else "generated"
-            })
+        images = [_img_to_dict(img) for img in response.images]
         
         return GenerateResponse(
             text=response.text,
@@ -199,7 +527,10 @@ async def generate_content(request: GenerateRequest, http_request: Request):
 
 
 @app.post("/chat", response_model=ChatResponse)
-async def chat_with_history(request: ChatRequest, http_request: Request):
+async def chat_with_history(
+    request: ChatRequest,
+    current_client: GeminiClient = Depends(client_dep),
+):
     """
     Chat with conversation history support
     
@@ -210,27 +541,8 @@ async def chat_with_history(request: ChatRequest, http_request: Request):
          -d '{"prompt":"你好","model":"gemini-2.5-flash"}'
     """
     
-    # Extract cookies from request header
-    req_psid, req_psidts = extract_cookies_from_request(http_request)
-    
-    if not req_psid:
-        raise HTTPException(
-            status_code=400,
-            detail="Missing required cookie: __Secure-1PSID. Please provide Gemini cookies in the Cookie header."
-        )
-    
-    # Get client for these specific cookies
-    current_client = await get_client_for_cookies(req_psid, req_psidts)
-    
     # Map model name to Model enum
-    model_mapping = {
-        "gemini-3.0-pro": Model.G_3_0_PRO,
-        "gemini-2.5-pro": Model.G_2_5_PRO,
-        "gemini-2.5-flash": Model.G_2_5_FLASH,
-        "unspecified": Model.UNSPECIFIED,
-    }
-    
-    model = model_mapping.get(request.model, Model.G_2_5_FLASH)
+    model = MODEL_MAPPING.get(request.model, _DEFAULT_MODEL)
     
     try:
         # Create chat session with metadata if provided
@@ -251,14 +563,7 @@ async def chat_with_history(request: ChatRequest, http_request: Request):
         response = await chat.send_message(request.prompt)
         
         # Extract images information
-        images = []
-        for img in response.images:
-            images.append({
-                "url": img.url,
-                "title": img.title,
-                "alt": img.alt,
-                "type": "web" if hasattr(img, "proxy") else "generated"
-            })
+        images = [_img_to_dict(img) for img in response.images]
         
         return ChatResponse(
             text=response.text,
@@ -277,7 +582,10 @@ async def chat_with_history(request: ChatRequest, http_request: Request):
 
 
 @app.post("/generate-image", response_model=GenerateResponse)
-async def generate_image(request: ImageGenerateRequest, http_request: Request):
+async def generate_image(
+    request: ImageGenerateRequest,
+    current_client: GeminiClient = Depends(client_dep),
+):
     """
     Generate images using Gemini
     
@@ -288,27 +596,8 @@ async def generate_image(request: ImageGenerateRequest, http_request: Request):
          -d '{"prompt":"Generate a cute cat image","model":"gemini-2.5-flash"}'
     """
     
-    # Extract cookies from request header
-    req_psid, req_psidts = extract_cookies_from_request(http_request)
-    
-    if not req_psid:
-        raise HTTPException(
-            status_code=400,
-            detail="Missing required cookie: __Secure-1PSID. Please provide Gemini cookies in the Cookie header."
-        )
-    
-    # Get client for these specific cookies
-    current_client = await get_client_for_cookies(req_psid, req_psidts)
-    
     # Map model name to Model enum
-    model_mapping = {
-        "gemini-3.0-pro": Model.G_3_0_PRO,
-        "gemini-2.5-pro": Model.G_2_5_PRO,
-        "gemini-2.5-flash": Model.G_2_5_FLASH,
-        "unspecified": Model.UNSPECIFIED,
-    }
-    
-    model = model_mapping.get(request.model, Model.G_2_5_FLASH)
+    model = MODEL_MAPPING.get(request.model, _DEFAULT_MODEL)
     
     try:
         # Try different prompt variations for image generation
@@ -319,28 +608,33 @@ async def generate_image(request: ImageGenerateRequest, http_request: Request):
             f"Make an image: {request.prompt}"
         ]
         
+        # Send all variations at once and take the first one that comes back with images
+        tasks = [
+            asyncio.create_task(current_client.generate_content(prompt=p, model=model))
+            for p in prompts_to_try
+        ]
+        
         last_error = None
         
-        for prompt_variation in prompts_to_try:
-            try:
-                # Generate content
-                response = await current_client.generate_content(
-                    prompt=prompt_variation,
-                    model=model
-                )
-                
-                # Extract images information
-                images = []
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    response = await next_done
+                except Exception as e:
+                    last_error = str(e)
+                    continue
                 
-                # Check for generated images first
-                for img in response.images:
-                    if hasattr(img, 'url') and img.url:
-                        images.append({
-                            "url": img.url,
-                            "title": getattr(img, 'title', 'Generated Image'),
-                            "alt": getattr(img, 'alt', ''),
-                            "type": "generated" if 'googleusercontent.com/image_generation_content' in img.url else "web"
-                        })
+                # Extract images information, tagging generated ones by their URL
+                images = [
+                    {
+                        "url": img.url,
+                        "title": getattr(img, 'title', 'Generated Image'),
+                        "alt": getattr(img, 'alt', ''),
+                        "type": "generated" if 'googleusercontent.com/image_generation_content' in img.url else "web"
+                    }
+                    for img in response.images
+                    if getattr(img, 'url', None)
+                ]
                 
                 # If we got images, return success
                 if images:
@@ -355,12 +649,15 @@ async def generate_image(request: ImageGenerateRequest, http_request: Request):
                         }
                     )
                 
-                # If no images but got text response, continue to next prompt
-                last_error = f"No images generated with prompt: {prompt_variation}"
-                
-            except Exception as e:
-                last_error = str(e)
-                continue
+                # If no images but got text response, wait for the other variations
+                last_error = "No images generated with any prompt variation"
+        finally:
+            # Drop the variations still running once we have a winner (or are cancelled)
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            # Consume the losers' results so their exceptions are not reported as never retrieved
+            await asyncio.gather(*tasks, return_exceptions=True)
         
         # If all prompts failed, raise the last error
         raise Exception(last_error or "Failed to generate image with all prompt variations")
@@ -373,22 +670,12 @@ async def generate_image(request: ImageGenerateRequest, http_request: Request):
 
 
 @app.post("/test-image-gen")
-async def test_image_generation(http_request: Request):
+async def test_image_generation(
+    current_client: GeminiClient = Depends(client_dep),
+):
     """
     Simple test endpoint for image generation debugging
     """
-    # Extract cookies from request header
-    req_psid, req_psidts = extract_cookies_from_request(http_request)
-    
-    if not req_psid:
-        raise HTTPException(
-            status_code=400,
-            detail="Missing required cookie: __Secure-1PSID"
-        )
-    
-    # Get client for these specific cookies
-    current_client = await get_client_for_cookies(req_psid, req_psidts)
-    
     try:
         # Simple test prompt
         response = await current_client.generate_content(
@@ -414,10 +701,11 @@ async def test_image_generation(http_request: Request):
 
 @app.post("/edit-image", response_model=GenerateResponse)
 async def edit_image(
+    background: BackgroundTasks,
     prompt: str = Form(...),
     model: str = Form("gemini-2.5-flash"),
     image: UploadFile = File(...),
-    http_request: Request = None
+    current_client: GeminiClient = Depends(client_dep),
 ):
     """
     Edit images using Gemini
@@ -430,81 +718,59 @@ async def edit_image(
          -F "image=@/path/to/image.jpg"
     """
     
-    # Extract cookies from request header
-    req_psid, req_psidts = extract_cookies_from_request(http_request)
-    
-    if not req_psid:
-        raise HTTPException(
-            status_code=400,
-            detail="Missing required cookie: __Secure-1PSID. Please provide Gemini cookies in the Cookie header."
-        )
-    
-    # Get client for these specific cookies
-    current_client = await get_client_for_cookies(req_psid, req_psidts)
-    
     # Map model name to Model enum
-    model_mapping = {
-        "gemini-3.0-pro": Model.G_3_0_PRO,
-        "gemini-2.5-pro": Model.G_2_5_PRO,
-        "gemini-2.5-flash": Model.G_2_5_FLASH,
-        "unspecified": Model.UNSPECIFIED,
-    }
-    
-    model_enum = model_mapping.get(model, Model.G_2_5_FLASH)
+    model_enum = MODEL_MAPPING.get(model, _DEFAULT_MODEL)
     
+    temp_files = []
+    cleanup_deferred = False
     try:
         # Save uploaded file temporarily
-        with tempfile.NamedTemporaryFile(delete=False, suffix=Path(image.filename).suffix) as temp_file:
-            content = await image.read()
-            temp_file.write(content)
-            temp_file_path = temp_file.name
+        temp_files.append(await _spool_upload(image))
         
-        try:
-            # Generate content with image
-            response = await current_client.generate_content(
-                prompt=f"Edit this image: {prompt}",
-                files=[temp_file_path],
-                model=model_enum
-            )
-            
-            # Extract images information
-            images = []
-            for img in response.images:
-                images.append({
-                    "url": img.url,
-                    "title": img.title,
-                    "alt": img.alt,
-                    "type": "web" if hasattr(img, "proxy") else "generated"
-                })
-            
-            return GenerateResponse(
-                text=response.text,
-                thoughts=response.thoughts,
-                images=images,
-                chat_metadata={
-                    "chat_id": response.metadata[0] if len(response.metadata) > 0 else None,
-                    "reply_id": response.metadata[1] if len(response.metadata) > 1 else None,
-                    "reply_candidate_id": response.rcid
-                }
-            )
-            
-        finally:
-            # Clean up temporary file
-            os.unlink(temp_file_path)
+        # Generate content with image
+        response = await current_client.generate_content(
+            prompt=f"Edit this image: {prompt}",
+            files=temp_files,
+            model=model_enum
+        )
+        
+        # Extract images information
+        images = [_img_to_dict(img) for img in response.images]
+        
+        result = GenerateResponse(
+            text=response.text,
+            thoughts=response.thoughts,
+            images=images,
+            chat_metadata={
+                "chat_id": response.metadata[0] if len(response.metadata) > 0 else None,
+                "reply_id": response.metadata[1] if len(response.metadata) > 1 else None,
+                "reply_candidate_id": response.rcid
+            }
+        )
+        
+        # Clean up temporary file after the response has been sent
+        background.add_task(_remove_temp_files, temp_files)
+        cleanup_deferred = True
+        return result
         
     except Exception as e:
         raise HTTPException(
             status_code=500,
             detail=f"Failed to edit image: {str(e)}"
         )
+    finally:
+        # Background tasks don't run for error responses, clean up here instead
+        if not cleanup_deferred:
+            await _remove_temp_files(temp_files)
 
 
 @app.post("/generate-with-files", response_model=GenerateResponse)
 async def generate_with_files(
+    background: BackgroundTasks,
     prompt: str = Form(...),
     model: str = Form("gemini-2.5-flash"),
     files: List[UploadFile] = File(...),
-    http_request: Request = None
+    current_client: GeminiClient = Depends(client_dep),
 ):
     """
     Generate content with file attachments
@@ -518,37 +784,20 @@ async def generate_with_files(
          -F "files=@/path/to/file2.jpg"
     """
     
-    # Extract cookies from request header
-    req_psid, req_psidts = extract_cookies_from_request(http_request)
-    
-    if not req_psid:
-        raise HTTPException(
-            status_code=400,
-            detail="Missing required cookie: __Secure-1PSID. Please provide Gemini cookies in the Cookie header."
-        )
-    
-    # Get client for these specific cookies
-    current_client = await get_client_for_cookies(req_psid, req_psidts)
-    
     # Map model name to Model enum
-    model_mapping = {
-        "gemini-3.0-pro": Model.G_3_0_PRO,
-        "gemini-2.5-pro": Model.G_2_5_PRO,
-        "gemini-2.5-flash": Model.G_2_5_FLASH,
-        "unspecified": Model.UNSPECIFIED,
-    }
-    
-    model_enum = model_mapping.get(model, Model.G_2_5_FLASH)
+    model_enum = MODEL_MAPPING.get(model, _DEFAULT_MODEL)
     
     temp_files = []
+    cleanup_deferred = False
     try:
-        # Save uploaded files temporarily
-        for file in files:
-            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=Path(file.filename).suffix)
-            content = await file.read()
-            temp_file.write(content)
-            temp_file.close()
-            temp_files.append(temp_file.name)
+        # Save uploaded files temporarily, all at once since they don't depend on each other
+        results = await asyncio.gather(
+            *[_spool_upload(file) for file in files], return_exceptions=True
+        )
+        temp_files = [r for r in results if isinstance(r, str)]
+        for r in results:
+            if isinstance(r, BaseException):
+                raise r
         
         # Generate content with files
         response = await current_client.generate_content(
@@ -558,16 +807,9 @@ async def generate_with_files(
         )
         
         # Extract images information
-        images = []
-        for img in response.images:
-            images.append({
-                "url": img.url,
-                "title": img.title,
-                "alt": img.alt,
-                "type": "web" if hasattr(img, "proxy") else "generated"
-            })
+        images = [_img_to_dict(img) for img in response.images]
         
-        return GenerateResponse(
+        result = GenerateResponse(
             text=response.text,
             thoughts=response.thoughts,
             images=images,
@@ -578,171 +820,138 @@ async def generate_with_files(
             }
         )
         
+        # Clean up temporary files after the response has been sent
+        background.add_task(_remove_temp_files, temp_files)
+        cleanup_deferred = True
+        return result
+        
     except Exception as e:
         raise HTTPException(
             status_code=500,
             detail=f"Failed to generate content with files: {str(e)}"
         )
     finally:
-        # Clean up temporary files
-        for temp_file_path in temp_files:
-            try:
-                os.unlink(temp_file_path)
-            except:
-                pass
+        # Background tasks don't run for error responses, clean up here instead
+        if not cleanup_deferred:
+            await _remove_temp_files(temp_files)
 
 
 @app.get("/download-image")
-async def download_image(url: str, http_request: Request):
+async def download_image(
+    url: str,
+    current_client: GeminiClient = Depends(client_dep),
+    http: httpx.AsyncClient = Depends(http_client_dep),
+):
     """
-    Proxy download for generated images using GeneratedImage.save()
+    Proxy download for generated images, streamed straight from upstream to the caller
     """
     
-    # Extract cookies from request header
-    req_psid, req_psidts = extract_cookies_from_request(http_request)
-    
-    if not req_psid:
-        raise HTTPException(
-            status_code=400,
-            detail="Missing required cookie: __Secure-1PSID"
-        )
-    
     try:
-        from .types import GeneratedImage
-        import tempfile
-        import os
-        
-        # Get the initialized client which has all the necessary cookies
-        current_client = await get_client_for_cookies(req_psid, req_psidts)
-        
-        # Use the client's cookies (which include all necessary cookies from initialization)
-        cookies = current_client.cookies
-            
-        # Create GeneratedImage instance with the complete cookies
-        generated_image = GeneratedImage(
-            url=url,
-            title="Downloaded Image",
-            cookies=cookies
-        )
-        
-        # Use temporary directory to save the image
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # Save the image using the built-in method
-            saved_path = await generated_image.save(
-                path=temp_dir,
-                filename="temp_image.png",
-                verbose=False
-            )
-            
-            if saved_path and os.path.exists(saved_path):
-                # Read the saved file and return its content
-                with open(saved_path, "rb") as f:
-                    image_content = f.read()
-                
-                return Response(
-                    content=image_content,
-                    media_type="image/png",
-                    headers={
-                        "Content-Disposition": "inline",
-                        "Cache-Control": "public, max-age=3600"
-                    }
-                )
-            else:
-                raise HTTPException(
-                    status_code=500,
-                    detail="Failed to save image"
-                )
-                
+        # Same as GeneratedImage.save(full_size=True), request the full size image instead of the preview
+        upstream = await _open_image_stream(http, f"{url}=s2048", current_client.cookies)
     except Exception as e:
         raise HTTPException(
             status_code=500,
             detail=f"Error downloading image: {str(e)}"
         )
 
+    async def iter_image():
+        try:
+            async for chunk in upstream.aiter_bytes(_DOWNLOAD_CHUNK_SIZE):
+                yield chunk
+        finally:
+            await upstream.aclose()
+
+    return StreamingResponse(
+        iter_image(),
+        media_type="image/png",
+        headers={
+            "Content-Disposition": "inline",
+            "Cache-Control": "public, max-age=3600"
+        }
+    )
+
+
+# Static responses are serialized once at import time
+_ROOT_BYTES = orjson.dumps({
+    "service": "Gemini WebAPI Server",
+    "version": "1.0.0",
+    "endpoints": {
+        "/generate": {
+            "method": "POST",
+            "description": "Generate text content",
+            "example": 'curl -X POST "https://g.subx.fun/generate" -H "Content-Type: application/json" -H "Cookie: __Secure-1PSID=xxx; __Secure-1PSIDTS=xxx" -d \'{"prompt":"Hello","model":"gemini-2.5-flash"}\''
+        },
+        "/chat": {
+            "method": "POST", 
+            "description": "Chat with conversation history",
+            "example": 'curl -X POST "https://g.subx.fun/chat" -H "Content-Type: application/json" -H "Cookie: __Secure-1PSID=xxx; __Secure-1PSIDTS=xxx" -d \'{"prompt":"Hello","model":"gemini-2.5-flash"}\''
+        },
+        "/generate-image": {
+            "method": "POST",
+            "description": "Generate images",
+            "example": 'curl -X POST "https://g.subx.fun/generate-image" -H "Content-Type: application/json" -H "Cookie: __Secure-1PSID=xxx; __Secure-1PSIDTS=xxx" -d \'{"prompt":"A cute cat","model":"gemini-2.5-flash"}\''
+        },
+        "/edit-image": {
+            "method": "POST",
+            "description": "Edit images with multipart form",
+            "example": 'curl -X POST "https://g.subx.fun/edit-image" -H "Cookie: __Secure-1PSID=xxx; __Secure-1PSIDTS=xxx" -F "prompt=Make colorful" -F "image=@image.jpg"'
+        },
+        "/generate-with-files": {
+            "method": "POST",
+            "description": "Generate content with file attachments",
+            "example": 'curl -X POST "https://g.subx.fun/generate-with-files" -H "Cookie: __Secure-1PSID=xxx; __Secure-1PSIDTS=xxx" -F "prompt=Analyze" -F "files=@file.pdf"'
+        },
+        "/models": {
+            "method": "GET",
+            "description": "List available models"
+        },
+        "/health": {
+            "method": "GET", 
+            "description": "Health check"
+        }
+    },
+    "authentication": "Provide __Secure-1PSID and __Secure-1PSIDTS cookies in Cookie header"
+})
+_HEALTH_BYTES = orjson.dumps({"status": "healthy", "service": "gemini-webapi"})
+_MODELS_BYTES = orjson.dumps({
+    "models": [
+        {
+            "name": "gemini-3.0-pro",
+            "description": "Gemini 3.0 Pro"
+        },
+        {
+            "name": "gemini-2.5-pro", 
+            "description": "Gemini 2.5 Pro"
+        },
+        {
+            "name": "gemini-2.5-flash",
+            "description": "Gemini 2.5 Flash (Default)"
+        },
+        {
+            "name": "unspecified",
+            "description": "Unspecified model"
+        }
+    ]
+})
+
 
 @app.get("/")
 async def root():
     """API information and available endpoints"""
-    return {
-        "service": "Gemini WebAPI Server",
-        "version": "1.0.0",
-        "endpoints": {
-            "/generate": {
-                "method": "POST",
-                "description": "Generate text content",
-                "example": 'curl -X POST "https://g.subx.fun/generate" -H "Content-Type: application/json" -H "Cookie: __Secure-1PSID=xxx; __Secure-1PSIDTS=xxx" -d \'{"prompt":"Hello","model":"gemini-2.5-flash"}\''
-            },
-            "/chat": {
-                "method": "POST", 
-                "description": "Chat with conversation history",
-                "example": 'curl -X POST "https://g.subx.fun/chat" -H "Content-Type: application/json" -H "Cookie: __Secure-1PSID=xxx; __Secure-1PSIDTS=xxx" -d \'{"prompt":"Hello","model":"gemini-2.5-flash"}\''
-            },
-            "/generate-image": {
-                "method": "POST",
-                "description": "Generate images",
-                "example": 'curl -X POST "https://g.subx.fun/generate-image" -H "Content-Type: application/json" -H "Cookie: __Secure-1PSID=xxx; __Secure-1PSIDTS=xxx" -d \'{"prompt":"A cute cat","model":"gemini-2.5-flash"}\''
-            },
-            "/edit-image": {
-                "method": "POST",
-                "description": "Edit images with multipart form",
-                "example": 'curl -X POST "https://g.subx.fun/edit-image" -H "Cookie: __Secure-1PSID=xxx; __Secure-1PSIDTS=xxx" -F "prompt=Make colorful" -F "image=@image.jpg"'
-            },
-            "/generate-with-files": {
-                "method": "POST",
-                "description": "Generate content with file attachments",
-                "example": 'curl -X POST "https://g.subx.fun/generate-with-files" -H "Cookie: __Secure-1PSID=xxx; __Secure-1PSIDTS=xxx" -F "prompt=Analyze" -F "files=@file.pdf"'
-            },
-            "/models": {
-                "method": "GET",
-                "description": "List available models"
-            },
-            "/health": {
-                "method": "GET", 
-                "description": "Health check"
-            }
-        },
-        "authentication": "Provide __Secure-1PSID and __Secure-1PSIDTS cookies in Cookie header"
-    }
+    return Response(content=_ROOT_BYTES, media_type="application/json")
 
 
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    return {"status": "healthy", "service": "gemini-webapi"}
+    return Response(content=_HEALTH_BYTES, media_type="application/json")
 
 
 @app.get("/models")
 async def list_models():
     """List available models"""
-    return {
-        "models": [
-            {
-                "name": "gemini-3.0-pro",
-                "description": "Gemini 3.0 Pro"
-            },
-            {
-                "name": "gemini-2.5-pro", 
-                "description": "Gemini 2.5 Pro"
-            },
-            {
-                "name": "gemini-2.5-flash",
-                "description": "Gemini 2.5 Flash (Default)"
-            },
-            {
-                "name": "unspecified",
-                "description": "Unspecified model"
-            }
-        ]
-    }
-
-
-@app.on_event("shutdown")
-async def shutdown_event():
-    """Cleanup on shutdown"""
-    for client in client_cache.values():
-        if client._running:
-            await client.close()
-    client_cache.clear()
+    return Response(content=_MODELS_BYTES, media_type="application/json")
 
 
 if __name__ == "__main__":
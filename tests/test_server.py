@@ -0,0 +1,510 @@
+import asyncio
+import os
+import time
+import unittest
+from contextlib import suppress
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from unittest.mock import patch
+
+import httpx
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+from gemini_webapi import server
+
+
+class FakeModelOutput:
+    def __init__(self, text):
+        self.text = text
+        self.thoughts = None
+        self.images = []
+        self.metadata = ["chat_id", "reply_id"]
+        self.rcid = "rcid"
+
+
+class FakeGeminiClient:
+    """Stand-in for GeminiClient, `secure_1psid="bad"` makes init() fail"""
+
+    init_calls = 0
+    generate_calls = 0
+    seen_files = []
+
+    def __init__(self, secure_1psid, secure_1psidts=None):
+        self.secure_1psid = secure_1psid
+        self.cookies = {"__Secure-1PSID": secure_1psid}
+        self._running = False
+        self.close_calls = 0
+
+    async def init(self, **kwargs):
+        FakeGeminiClient.init_calls += 1
+        await asyncio.sleep(0.05)
+        if self.secure_1psid == "bad":
+            raise RuntimeError("expired cookie")
+        self._running = True
+
+    async def generate_content(self, prompt, model=None, files=None):
+        FakeGeminiClient.generate_calls += 1
+        for path in files or []:
+            # Files must be fully written before the upstream call
+            FakeGeminiClient.seen_files.append((path, os.path.getsize(path)))
+        await asyncio.sleep(0.05)
+        if prompt == "fail":
+            raise RuntimeError("upstream error")
+        return FakeModelOutput(prompt)
+
+    async def close(self):
+        self.close_calls += 1
+        self._running = False
+        if self.secure_1psid == "close-fails":
+            raise RuntimeError("close failed")
+
+
+def reset_server_state():
+    FakeGeminiClient.init_calls = 0
+    FakeGeminiClient.generate_calls = 0
+    FakeGeminiClient.seen_files = []
+    server._CLIENT_CACHE.clear()
+    server._CLIENT_INITS.clear()
+    server._CLIENT_USERS.clear()
+    server._RETIRED_IN_USE.clear()
+    server._INFLIGHT.clear()
+
+
+class FakeClientMixin:
+    """Patch server.GeminiClient with FakeGeminiClient and reset the server's module state around each test"""
+
+    def setUp(self):
+        super().setUp()
+        reset_server_state()
+        patcher = patch.object(server, "GeminiClient", FakeGeminiClient)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(reset_server_state)
+
+
+class TestClientCache(FakeClientMixin, unittest.IsolatedAsyncioTestCase):
+    async def test_concurrent_requests_share_one_init(self):
+        clients = await asyncio.gather(
+            *[server.get_client_for_cookies("good") for _ in range(6)]
+        )
+        self.assertEqual(FakeGeminiClient.init_calls, 1)
+        self.assertEqual(len({id(c) for c in clients}), 1)
+        self.assertFalse(server._CLIENT_INITS)
+
+    async def test_concurrent_failed_inits_fail_together(self):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        results = await asyncio.gather(
+            *[server.get_client_for_cookies("bad") for _ in range(6)],
+            return_exceptions=True,
+        )
+        self.assertLess(loop.time() - start, 0.2)
+        self.assertEqual(FakeGeminiClient.init_calls, 1)
+        for result in results:
+            self.assertIsInstance(result, HTTPException)
+            self.assertEqual(result.status_code, 401)
+        self.assertFalse(server._CLIENT_INITS)
+
+    async def test_lru_eviction_closes_idle_client(self):
+        with patch.object(server, "_CACHE_MAX", 1):
+            first = await server.get_client_for_cookies("a")
+            await server.get_client_for_cookies("b")
+        self.assertEqual(list(server._CLIENT_CACHE), ["b:"])
+        self.assertFalse(first._running)
+
+    async def test_eviction_defers_close_of_client_in_use(self):
+        with patch.object(server, "_CACHE_MAX", 1):
+            dep = server.client_dep(("a", None))
+            first = await dep.__anext__()
+            await server.get_client_for_cookies("b")
+
+            self.assertTrue(first._running)
+            self.assertIn(first, server._RETIRED_IN_USE)
+
+            await dep.aclose()
+        self.assertFalse(first._running)
+        self.assertFalse(server._RETIRED_IN_USE)
+        self.assertFalse(server._CLIENT_USERS)
+
+    async def test_failing_close_does_not_fail_eviction(self):
+        with patch.object(server, "_CACHE_MAX", 1):
+            await server.get_client_for_cookies("close-fails")
+            client = await server.get_client_for_cookies("b")
+        self.assertTrue(client._running)
+
+
+    async def test_sweeper_drops_idle_and_dead_clients(self):
+        def running_client(psid):
+            client = FakeGeminiClient(psid)
+            client._running = True
+            return client
+
+        fresh, idle, dead, busy = (running_client(k) for k in ("fresh", "idle", "dead", "busy"))
+        dead._running = False
+        now = time.monotonic()
+        server._CLIENT_CACHE.update(
+            {
+                "fresh:": (fresh, now),
+                "idle:": (idle, now - 10),
+                "dead:": (dead, now),
+                "busy:": (busy, now - 10),
+            }
+        )
+        server._CLIENT_USERS[busy] += 1
+
+        with patch.object(server, "_SWEEP_INTERVAL", 0.01), patch.object(server, "_CLIENT_IDLE_TTL", 5):
+            sweeper = asyncio.create_task(server._sweep_client_cache())
+            await asyncio.sleep(0.05)
+            sweeper.cancel()
+            with suppress(asyncio.CancelledError):
+                await sweeper
+
+        self.assertEqual(list(server._CLIENT_CACHE), ["fresh:"])
+        self.assertEqual(idle.close_calls, 1)
+        self.assertFalse(idle._running)
+        # Dead clients are only dropped, there is nothing left to close
+        self.assertEqual(dead.close_calls, 0)
+        # The idle client still serving a request is retired, not closed
+        self.assertTrue(busy._running)
+        self.assertEqual(busy.close_calls, 0)
+        self.assertEqual(server._RETIRED_IN_USE, {busy})
+
+
+class TestFastCORS(unittest.TestCase):
+    def setUp(self):
+        self.client = TestClient(server.app)
+
+    def test_preflight_short_circuits(self):
+        response = self.client.options(
+            "/generate",
+            headers={
+                "Origin": "https://example.com",
+                "Access-Control-Request-Method": "POST",
+                "Access-Control-Request-Headers": "content-type",
+            },
+        )
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(
+            response.headers["access-control-allow-origin"], "https://example.com"
+        )
+        self.assertEqual(response.headers["access-control-allow-credentials"], "true")
+        self.assertEqual(response.headers["access-control-allow-headers"], "content-type")
+        self.assertEqual(response.headers["access-control-max-age"], "600")
+        self.assertEqual(response.headers["vary"], "Origin")
+        self.assertNotIn("content-length", response.headers)
+
+    def test_simple_request_gets_cors_headers(self):
+        response = self.client.get("/health", headers={"Origin": "https://example.com"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.headers["access-control-allow-origin"], "https://example.com"
+        )
+        self.assertEqual(response.headers["vary"], "Origin")
+
+    def test_same_origin_request_is_untouched(self):
+        response = self.client.get("/health")
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("access-control-allow-origin", response.headers)
+
+    def test_existing_vary_header_is_extended(self):
+        async def app(scope, receive, send):
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": 200,
+                    "headers": [(b"vary", b"Accept-Encoding")],
+                }
+            )
+            await send({"type": "http.response.body", "body": b""})
+
+        client = TestClient(server.FastCORS(app))
+        response = client.get("/", headers={"Origin": "https://example.com"})
+        self.assertEqual(response.headers.get_list("vary"), ["Accept-Encoding, Origin"])
+
+
+class TestGenerateSingleFlight(FakeClientMixin, unittest.IsolatedAsyncioTestCase):
+    async def post_generate(self, http, prompt):
+        return await http.post(
+            "/generate",
+            json={"prompt": prompt},
+            headers={"Cookie": "__Secure-1PSID=good"},
+        )
+
+    async def test_identical_requests_share_upstream_call(self):
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            responses = await asyncio.gather(
+                *[self.post_generate(http, "hello") for _ in range(5)],
+                self.post_generate(http, "other"),
+            )
+        self.assertEqual([r.status_code for r in responses], [200] * 6)
+        self.assertEqual([r.json()["text"] for r in responses], ["hello"] * 5 + ["other"])
+        self.assertEqual(FakeGeminiClient.generate_calls, 2)
+        self.assertFalse(server._INFLIGHT)
+
+    async def test_shared_failure_reaches_every_caller(self):
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            responses = await asyncio.gather(
+                *[self.post_generate(http, "fail") for _ in range(3)]
+            )
+        self.assertEqual([r.status_code for r in responses], [500] * 3)
+        self.assertEqual(FakeGeminiClient.generate_calls, 1)
+        self.assertFalse(server._INFLIGHT)
+
+    async def test_finished_call_is_not_reused(self):
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            await self.post_generate(http, "hello")
+            await self.post_generate(http, "hello")
+        self.assertEqual(FakeGeminiClient.generate_calls, 2)
+
+
+class FakeImage:
+    def __init__(self, url):
+        self.url = url
+        self.title = "Generated Image"
+        self.alt = ""
+
+
+class RacingGeminiClient(FakeGeminiClient):
+    """Prompt variations of /generate-image finish differently: one fails, one has images, one is slow"""
+
+    tasks = []
+    cancelled = []
+
+    async def generate_content(self, prompt, model=None, files=None):
+        RacingGeminiClient.tasks.append(asyncio.current_task())
+        if prompt.startswith("Create an image of"):
+            raise RuntimeError("upstream error")
+        if prompt.startswith("Generate a picture showing"):
+            await asyncio.sleep(0.05)
+            output = FakeModelOutput("here you go")
+            output.images = [FakeImage("https://lh3.googleusercontent.com/image_generation_content/1")]
+            return output
+        if prompt.startswith("Draw"):
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                RacingGeminiClient.cancelled.append(prompt)
+                raise
+        return FakeModelOutput("no images")
+
+
+class TestGenerateImageRace(FakeClientMixin, unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        super().setUp()
+        RacingGeminiClient.tasks = []
+        RacingGeminiClient.cancelled = []
+        patcher = patch.object(server, "GeminiClient", RacingGeminiClient)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_first_variation_with_images_wins(self):
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            response = await http.post(
+                "/generate-image",
+                json={"prompt": "a cat"},
+                headers={"Cookie": "__Secure-1PSID=good"},
+            )
+            self.assertLess(loop.time() - start, 1)
+
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body["text"], "here you go")
+        self.assertEqual(body["images"][0]["type"], "generated")
+        self.assertEqual(RacingGeminiClient.cancelled, ["Draw a cat"])
+        self.assertEqual(len(RacingGeminiClient.tasks), 4)
+        self.assertTrue(all(task.done() for task in RacingGeminiClient.tasks))
+        self.assertEqual(asyncio.all_tasks(), {asyncio.current_task()})
+
+
+class TestMissingCookie(FakeClientMixin, unittest.TestCase):
+    body = b'{"detail":"Missing required cookie: __Secure-1PSID. Please provide Gemini cookies in the Cookie header."}'
+
+    def assert_missing_cookie(self, response):
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.content, self.body)
+        self.assertEqual(response.headers["content-length"], "105")
+        self.assertEqual(response.headers["content-type"], "application/json")
+
+    def test_generate_without_cookie(self):
+        client = TestClient(server.app)
+        # The pre-rendered response object is shared, a second request must get the same reply
+        for _ in range(2):
+            self.assert_missing_cookie(client.post("/generate", json={"prompt": "hello"}))
+        self.assertEqual(FakeGeminiClient.init_calls, 0)
+
+    def test_download_image_without_cookie(self):
+        client = TestClient(server.app)
+        for _ in range(2):
+            self.assert_missing_cookie(
+                client.get("/download-image", params={"url": "https://lh3.example/img"})
+            )
+        self.assertEqual(FakeGeminiClient.init_calls, 0)
+
+
+class TestUploadCleanup(FakeClientMixin, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = TestClient(server.app)
+        self.headers = {"Cookie": "__Secure-1PSID=good"}
+
+    def test_edit_image_removes_temp_file(self):
+        response = self.client.post(
+            "/edit-image",
+            data={"prompt": "make it blue"},
+            files={"image": ("cat.png", b"\x89PNG" * 1000)},
+            headers=self.headers,
+        )
+        self.assertEqual(response.status_code, 200)
+        [(path, size)] = FakeGeminiClient.seen_files
+        self.assertTrue(path.endswith(".png"))
+        self.assertEqual(size, 4000)
+        self.assertFalse(os.path.exists(path))
+
+    def test_generate_with_files_spools_and_removes_all_files(self):
+        payloads = [b"a" * 10, b"b" * 200_000]
+        response = self.client.post(
+            "/generate-with-files",
+            data={"prompt": "compare"},
+            files=[
+                ("files", ("a.txt", payloads[0])),
+                ("files", ("b.pdf", payloads[1])),
+            ],
+            headers=self.headers,
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            sorted(size for _, size in FakeGeminiClient.seen_files),
+            [len(p) for p in payloads],
+        )
+        for path, _ in FakeGeminiClient.seen_files:
+            self.assertFalse(os.path.exists(path))
+
+    def test_temp_files_removed_on_error(self):
+        response = self.client.post(
+            "/generate-with-files",
+            data={"prompt": "fail"},
+            files=[("files", ("a.txt", b"a")), ("files", ("b.txt", b"b"))],
+            headers=self.headers,
+        )
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(len(FakeGeminiClient.seen_files), 2)
+        for path, _ in FakeGeminiClient.seen_files:
+            self.assertFalse(os.path.exists(path))
+
+
+class TrackedStream(httpx.AsyncByteStream):
+    """Response body that records whether it was closed"""
+
+    def __init__(self, body=b""):
+        self.body = body
+        self.closed = False
+
+    async def __aiter__(self):
+        yield self.body
+
+    async def aclose(self):
+        self.closed = True
+
+
+class TestImageDownload(FakeClientMixin, unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        super().setUp()
+        self.requests = []
+        self.streams = []
+
+    def shared_client(self, routes):
+        """httpx client set up like the one lifespan creates, with a jar that rejects every cookie"""
+        return httpx.AsyncClient(
+            transport=self.transport(routes),
+            cookies=CookieJar(policy=DefaultCookiePolicy(allowed_domains=[])),
+        )
+
+    def transport(self, routes):
+        def handler(request):
+            self.requests.append(request)
+            status, headers, body = routes[str(request.url)]
+            stream = TrackedStream(body)
+            self.streams.append(stream)
+            return httpx.Response(status, headers=headers, stream=stream)
+
+        return httpx.MockTransport(handler)
+
+    async def test_redirect_chain_scopes_hop_cookies(self):
+        routes = {
+            "https://lh3.example/img=s2048": (
+                302,
+                [("location", "https://lh3.example/hop"), ("set-cookie", "hop=1; Path=/")],
+                b"",
+            ),
+            "https://lh3.example/hop": (302, [("location", "https://cdn.other/final")], b""),
+            "https://cdn.other/final": (200, [], b"png"),
+        }
+        async with self.shared_client(routes) as http:
+            response = await server._open_image_stream(
+                http, "https://lh3.example/img=s2048", {"__Secure-1PSID": "good"}
+            )
+            self.assertEqual(await response.aread(), b"png")
+
+        cookies = [r.headers.get("cookie") for r in self.requests]
+        self.assertEqual(
+            cookies,
+            [
+                "__Secure-1PSID=good",
+                # Host-only cookie from the first hop goes back to its own host only
+                "__Secure-1PSID=good; hop=1",
+                "__Secure-1PSID=good",
+            ],
+        )
+        self.assertTrue(all(stream.closed for stream in self.streams[:-1]))
+        # The shared client's own jar must stay empty
+        self.assertFalse(http.cookies)
+
+    async def test_too_many_redirects(self):
+        routes = {"https://lh3.example/loop": (302, [("location", "/loop")], b"")}
+        with patch.object(server, "_MAX_REDIRECTS", 3):
+            async with self.shared_client(routes) as http:
+                with self.assertRaises(httpx.TooManyRedirects):
+                    await server._open_image_stream(http, "https://lh3.example/loop", {})
+        self.assertEqual(len(self.requests), 4)
+        self.assertTrue(all(stream.closed for stream in self.streams))
+
+    def test_upstream_error_returns_500_and_closes_upstream(self):
+        routes = {"https://lh3.example/missing=s2048": (404, [], b"not found")}
+        with TestClient(server.app) as client:
+            server.app.state.http._transport = self.transport(routes)
+            response = client.get(
+                "/download-image",
+                params={"url": "https://lh3.example/missing"},
+                headers={"Cookie": "__Secure-1PSID=good"},
+            )
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(
+            response.json()["detail"], "Error downloading image: Error downloading image: 404 Not Found"
+        )
+        [stream] = self.streams
+        self.assertTrue(stream.closed)
+
+    def test_download_streams_image(self):
+        routes = {"https://lh3.example/img=s2048": (200, [], b"png" * 100_000)}
+        with TestClient(server.app) as client:
+            server.app.state.http._transport = self.transport(routes)
+            response = client.get(
+                "/download-image",
+                params={"url": "https://lh3.example/img"},
+                headers={"Cookie": "__Secure-1PSID=good"},
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b"png" * 100_000)
+        self.assertEqual(self.requests[0].headers["cookie"], "__Secure-1PSID=good")
+        [stream] = self.streams
+        self.assertTrue(stream.closed)
+
+
+if __name__ == "__main__":
+    unittest.main()